@@ -4,31 +4,60 @@ Proxmox VM Management Agent using Claude API
 A script that uses Claude's bash tool to manage Proxmox VMs
 """
 
+import functools
 import os
 import json
+import re
 import requests
+import selectors
+import shlex
+import subprocess
 import sys
-from typing import Dict, List, Optional
-
-class ProxmoxClaudeAgent:
-    def __init__(self, api_key: str):
-        self.api_key = api_key
-        self.api_url = "https://api.anthropic.com/v1/messages"
-        self.headers = {
-            "Content-Type": "application/json",
-            "x-api-key": api_key,
-            "anthropic-version": "2023-06-01"
-        }
-        self.conversation_history = []
-
-    def send_message_to_claude(self, message: str) -> Dict:
-        """Send message to Claude API with bash tool access"""
-
-        system_prompt = """You are a Proxmox VM management assistant. You have access to the bash tool and should use it to help manage Proxmox VMs.
+import threading
+import time
+import urllib3
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from requests.adapters import HTTPAdapter
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import quote
+
+API_URL = "https://api.anthropic.com/v1/messages"
+BASE_HEADERS = {
+    "Content-Type": "application/json",
+    "anthropic-version": "2023-06-01"
+}
+MODEL = "claude-sonnet-4-20250514"
+API_TIMEOUT = 120
+HISTORY_LIMIT = 20
+HISTORY_TARGET = HISTORY_LIMIT // 2
+BASH_WORKERS = 4
+CACHE_TTL = 10
+READ_ONLY_PREFIXES = ("pvesh get", "qm list", "qm status", "pct list", "pct status")
+MUTATING_COMMAND = re.compile(
+    r"\b(start|stop|shutdown|reboot|suspend|resume|create|destroy|delete|set|migrate|clone|rollback)\b"
+)
+COMMAND_TIMEOUT = 30
+COMMAND_OUTPUT_LIMIT = 256 * 1024
+OUTPUT_READ_SIZE = 64 * 1024
+TASK_POLL_INTERVAL = 0.5
+TOOL_OUTPUT_LIMIT = 8 * 1024
+TOOL_OUTPUT_HEAD = 4 * 1024
+TOOL_OUTPUT_TAIL = 2 * 1024
+JSON_ITEMS_KEPT = 20
+TOOL_RESULTS_KEPT = 6
+PVE_API_PORT = 8006
+PVESH_METHODS = {"get": "GET", "create": "POST", "set": "PUT", "delete": "DELETE"}
+# pvesh options that only affect how output is printed, with whether they take a value
+PVESH_FORMAT_OPTIONS = {"output-format": True, "noborder": False, "noheader": False, "human-readable": False, "quiet": False}
+SHELL_CHARS = set("|&;<>$`*?(){}[]~#!\\\n")
+
+SYSTEM_PROMPT = """You are a Proxmox VM management assistant. You have access to the bash tool and should use it to help manage Proxmox VMs.
 
 Key Proxmox commands you should know:
 - pvesh get /nodes - list nodes
 - pvesh get /nodes/{node}/qemu - list VMs on a node
+- pvesh get /cluster/resources --type vm - list VMs and containers on all nodes in one call (use this instead of querying each node)
 - pvesh get /nodes/{node}/qemu/{vmid}/status/current - get VM status
 - pvesh create /nodes/{node}/qemu/{vmid}/status/start - start VM
 - pvesh create /nodes/{node}/qemu/{vmid}/status/stop - stop VM
@@ -57,104 +86,581 @@ Guest Agent commands (for VMs/containers with Proxmox guest agent installed):
 
 Always use the bash tool to execute these commands and provide helpful, concise responses about VM management tasks."""
 
-        payload = {
-            "model": "claude-sonnet-4-20250514",
-            "max_tokens": 2000,
-            "system": system_prompt,
-            "messages": self.conversation_history + [{"role": "user", "content": message}],
-            "tools": [
-                {
-                    "name": "bash",
-                    "description": "Execute bash commands on the Proxmox system",
-                    "input_schema": {
-                        "type": "object",
-                        "properties": {
-                            "command": {
-                                "type": "string",
-                                "description": "The bash command to execute"
-                            }
-                        },
-                        "required": ["command"]
-                    }
+TOOLS = [
+    {
+        "name": "bash",
+        "description": "Execute bash commands on the Proxmox system",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "command": {
+                    "type": "string",
+                    "description": "The bash command to execute"
                 }
-            ]
+            },
+            "required": ["command"]
         }
+    }
+]
+
+# The cache breakpoint on the system block covers the tools that precede it.
+# Anthropic only caches prefixes of at least 1024 tokens for Sonnet 4; the
+# prompt and tool schema are about 600 tokens today, so the marker is ignored
+# until the static prefix grows past that minimum.
+SYSTEM_PROMPT_BLOCKS = [
+    {"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}
+]
+
+SUMMARY_PROMPT = """Summarize the conversation so far as short bullet points of facts about the Proxmox nodes, VMs and containers (IDs, names, state, errors seen) and what the user was trying to do. Reply with the bullet points only."""
+
+# Fields shared by every request; only the messages change per call
+PAYLOAD_BASE = {
+    "model": MODEL,
+    "max_tokens": 2000,
+    "system": SYSTEM_PROMPT_BLOCKS,
+    "tools": TOOLS
+}
+
+# Requests that map one-to-one onto a Proxmox command and can skip the Claude round trip
+INTENTS = [
+    (re.compile(r"(?:list|show)\s+(?:all\s+)?vms?", re.I), lambda m: "qm list"),
+    (re.compile(r"(?:list|show)\s+(?:all\s+)?(?:containers?|cts?)", re.I), lambda m: "pct list"),
+    (re.compile(r"(?:show\s+|list\s+)?cluster\s+(?:status|vms?|resources)", re.I), lambda m: "pvesh get /cluster/resources --type vm"),
+    (re.compile(r"(start|stop|shutdown|reboot)\s+vm\s+(\d+)", re.I), lambda m: f"qm {m[1].lower()} {m[2]}"),
+    (re.compile(r"(start|stop|shutdown|reboot)\s+(?:container|ct)\s+(\d+)", re.I), lambda m: f"pct {m[1].lower()} {m[2]}"),
+    (re.compile(r"(?:check\s+)?status\s+of\s+vm\s+(\d+)|vm\s+(\d+)\s+status", re.I), lambda m: f"qm status {m[1] or m[2]}"),
+    (re.compile(r"(?:check\s+)?status\s+of\s+(?:container|ct)\s+(\d+)|(?:container|ct)\s+(\d+)\s+status", re.I), lambda m: f"pct status {m[1] or m[2]}"),
+]
+
+def match_intent(message: str) -> Optional[str]:
+    """Return the Proxmox command for a message that matches a local intent"""
+    text = message.strip().rstrip(".!?").strip()
+    for pattern, build_command in INTENTS:
+        match = pattern.fullmatch(text)
+        if match:
+            return build_command(match)
+    return None
+
+def encode_payload(payload: Dict) -> bytes:
+    """Encode a request payload as compact UTF-8 JSON"""
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def condense_output(text: str) -> str:
+    """Shrink large command output before it is fed back to Claude"""
+    if len(text) <= TOOL_OUTPUT_LIMIT:
+        return text
+
+    # JSON output keeps its structure: long arrays are cut to their first items
+    try:
+        data = json.loads(text)
+    except ValueError:
+        data = None
+    if isinstance(data, list):
+        condensed = json.dumps(data, separators=(",", ":"))
+        if len(condensed) <= TOOL_OUTPUT_LIMIT:
+            return condensed
+        if len(data) > JSON_ITEMS_KEPT:
+            condensed = json.dumps(data[:JSON_ITEMS_KEPT], separators=(",", ":"))
+            if len(condensed) <= TOOL_OUTPUT_LIMIT:
+                return f"{condensed}\n...[{len(data) - JSON_ITEMS_KEPT} more items truncated]..."
+    elif isinstance(data, dict):
+        condensed = json.dumps(
+            {key: value[:JSON_ITEMS_KEPT] if isinstance(value, list) else value for key, value in data.items()},
+            separators=(",", ":")
+        )
+        if len(condensed) <= TOOL_OUTPUT_LIMIT:
+            if any(isinstance(value, list) and len(value) > JSON_ITEMS_KEPT for value in data.values()):
+                return f"{condensed}\n...[arrays truncated to {JSON_ITEMS_KEPT} items]..."
+            return condensed
+
+    truncated = len(text) - TOOL_OUTPUT_HEAD - TOOL_OUTPUT_TAIL
+    return f"{text[:TOOL_OUTPUT_HEAD]}\n...[TRUNCATED {truncated} characters]...\n{text[-TOOL_OUTPUT_TAIL:]}"
+
+def split_plain_command(command: str) -> Optional[List[str]]:
+    """Split a command into argv if it can run without a shell, else return None"""
+    if any(c in SHELL_CHARS for c in command):
+        return None
+    try:
+        tokens = shlex.split(command)
+    except ValueError:
+        return None
+    # Leading VAR=value assignments are a shell feature too
+    if not tokens or "=" in tokens[0]:
+        return None
+    return tokens
+
+def pvesh_to_rest(tokens: List[str]) -> Optional[Tuple[str, str, Dict]]:
+    """Translate pvesh argv into (HTTP method, API path, parameters), or None if it can't be"""
+    if len(tokens) < 3 or tokens[0] != "pvesh" or tokens[1] not in PVESH_METHODS or not tokens[2].startswith("/"):
+        return None
+
+    params = {}
+    args = tokens[3:]
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if not arg.startswith("--") or arg == "--":
+            return None
+        key, has_value, value = arg[2:].partition("=")
+        i += 1
+
+        if key in PVESH_FORMAT_OPTIONS:
+            # Formatting flags may carry an explicit 0/1, option values always follow
+            if not has_value and i < len(args) and (PVESH_FORMAT_OPTIONS[key] or args[i] in ("0", "1")):
+                i += 1
+            continue
+
+        if not has_value:
+            if i >= len(args) or args[i].startswith("--"):
+                return None
+            value = args[i]
+            i += 1
+        params.setdefault(key, []).append(value)
+
+    return PVESH_METHODS[tokens[1]], tokens[2], params
+
+def run_command(args, shell: bool) -> subprocess.CompletedProcess:
+    """Run a command, reading its output incrementally with a per-stream size cap"""
+    deadline = time.monotonic() + COMMAND_TIMEOUT
+    overflowed = None
+
+    with subprocess.Popen(args, shell=shell, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as process:
+        outputs = {process.stdout: bytearray(), process.stderr: bytearray()}
+
+        with selectors.DefaultSelector() as selector:
+            for pipe in outputs:
+                selector.register(pipe, selectors.EVENT_READ)
+
+            while selector.get_map() and not overflowed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    process.kill()
+                    raise subprocess.TimeoutExpired(args, COMMAND_TIMEOUT)
+
+                for key, _ in selector.select(remaining):
+                    chunk = os.read(key.fd, OUTPUT_READ_SIZE)
+                    if not chunk:
+                        selector.unregister(key.fileobj)
+                        continue
+
+                    output = outputs[key.fileobj]
+                    output += chunk
+                    if len(output) > COMMAND_OUTPUT_LIMIT:
+                        # Stop a runaway command instead of buffering all of its output
+                        del output[COMMAND_OUTPUT_LIMIT:]
+                        overflowed = key.fileobj
+                        process.kill()
+                        break
 
         try:
-            response = requests.post(self.api_url, headers=self.headers, json=payload)
+            returncode = process.wait(timeout=max(deadline - time.monotonic(), 0))
+        except subprocess.TimeoutExpired:
+            process.kill()
+            raise
+
+    for pipe, output in outputs.items():
+        if pipe is overflowed:
+            output += f"\n[truncated: output exceeded {COMMAND_OUTPUT_LIMIT // 1024} KiB, command was stopped]".encode()
+    stdout, stderr = (outputs[pipe].decode("utf-8", errors="replace") for pipe in (process.stdout, process.stderr))
+
+    result = subprocess.CompletedProcess(args, returncode, stdout, stderr)
+    # The exit status of a command stopped at the output cap is our kill, not its own failure
+    result.truncated = overflowed is not None
+    return result
+
+class ProxmoxClaudeAgent:
+    def __init__(self, api_key: str, pve_api_token: Optional[str] = None,
+                 pve_host: str = "127.0.0.1", pve_verify_ssl=False):
+        self.api_key = api_key
+        self.api_url = API_URL
+        self.headers = {**BASE_HEADERS, "x-api-key": api_key}
+        self.conversation_history = []
+
+        # Keep one pooled session so every turn reuses the same TLS connection
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
+        self.session.headers.update(self.headers)
+        threading.Thread(target=self.warm_up_connection, daemon=True).start()
+
+        # Shared worker pool for running a turn's bash commands side by side
+        self.executor = ThreadPoolExecutor(max_workers=BASH_WORKERS)
+
+        # Authenticated Proxmox API session that pvesh commands are sent through when a token is configured
+        self.pve_session = None
+        if pve_api_token:
+            self.pve_url = f"https://{pve_host}:{PVE_API_PORT}/api2/json"
+            self.pve_session = requests.Session()
+            self.pve_session.headers["Authorization"] = f"PVEAPIToken={pve_api_token}"
+            self.pve_session.verify = pve_verify_ssl
+            if not pve_verify_ssl:
+                # pveproxy uses a self-signed certificate by default
+                urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+        # Recent results of read-only Proxmox queries: command -> (timestamp, result)
+        self.command_cache = {}
+
+        # Bash commands started while their response was still streaming: tool_use id -> future
+        self.pending_tool_runs = {}
+
+    def warm_up_connection(self):
+        """Open the pooled TLS connection ahead of the first real request"""
+        try:
+            self.session.head(self.api_url, timeout=API_TIMEOUT)
+        except requests.exceptions.RequestException:
+            # The first real request simply opens its own connection
+            pass
+
+    def send_message_to_claude(self) -> Dict:
+        """Send the conversation history to Claude API with bash tool access"""
+        payload = {
+            **PAYLOAD_BASE,
+            "messages": self.conversation_history,
+            "stream": True
+        }
+        return self.stream_from_claude(payload)
+
+    def post_to_claude(self, payload: Dict) -> Dict:
+        """Post a request payload to the Claude API and return the decoded response"""
+        try:
+            response = self.session.post(self.api_url, data=encode_payload(payload), timeout=API_TIMEOUT)
             response.raise_for_status()
             return response.json()
         except requests.exceptions.RequestException as e:
             return {"error": f"API request failed: {str(e)}"}
 
-    def process_claude_response(self, response: Dict) -> str:
-        """Process Claude's response and execute any bash commands"""
+    def stream_from_claude(self, payload: Dict) -> Dict:
+        """Stream a response from the Claude API, starting bash commands as soon as their block is complete"""
+        started = []
+        response = self.read_claude_stream(payload, started)
+
+        if "error" in response and started:
+            # Commands launched before the failure still ran, so collect and report their output
+            outcomes = [(block, self.pending_tool_runs.pop(block["id"]).result()) for block in started]
+            response["tool_output"] = "".join(output_text for _, (_, output_text) in outcomes)
+            response["tool_summary"] = "\n".join(
+                f"`{block['input']['command']}`:\n{tool_result['content']}" for block, (tool_result, _) in outcomes
+            )
+
+        return response
+
+    def read_claude_stream(self, payload: Dict, started: List[Dict]) -> Dict:
+        """Read a streamed response, recording the bash blocks started along the way"""
+        message = None
+        partial_inputs = {}
+
+        try:
+            with self.session.post(self.api_url, data=encode_payload(payload), stream=True, timeout=API_TIMEOUT) as response:
+                response.raise_for_status()
+
+                for line in response.iter_lines():
+                    if not line.startswith(b"data:"):
+                        continue
+                    event = json.loads(line[5:])
+
+                    if event["type"] == "message_start":
+                        message = event["message"]
+                    elif event["type"] == "content_block_start":
+                        message["content"].append(event["content_block"])
+                    elif event["type"] == "content_block_delta":
+                        delta = event["delta"]
+                        if delta["type"] == "text_delta":
+                            message["content"][event["index"]]["text"] += delta["text"]
+                        elif delta["type"] == "input_json_delta":
+                            partial_inputs[event["index"]] = partial_inputs.get(event["index"], "") + delta["partial_json"]
+                    elif event["type"] == "content_block_stop":
+                        block = message["content"][event["index"]]
+                        if block["type"] == "tool_use":
+                            block["input"] = json.loads(partial_inputs.pop(event["index"], "") or "{}")
+                            if block["name"] == "bash":
+                                # Overlap the command with the rest of the generation
+                                self.pending_tool_runs[block["id"]] = self.executor.submit(self.execute_bash_block, block)
+                                started.append(block)
+                    elif event["type"] == "message_delta":
+                        message.update(event["delta"])
+                    elif event["type"] == "error":
+                        return {"error": f"API stream failed: {event['error']['message']}"}
+
+            if message is None:
+                return {"error": "API stream ended without a message"}
+            return message
+        except requests.exceptions.RequestException as e:
+            return {"error": f"API request failed: {str(e)}"}
+        except ValueError as e:
+            return {"error": f"Invalid API stream data: {str(e)}"}
+
+    def process_claude_response(self, response: Dict) -> Tuple[str, Optional[str]]:
+        """Process Claude's response and execute any bash commands
+
+        Returns the display text and, if the turn failed, a compact note about the failure for the history.
+        """
         if "error" in response:
-            return f"❌ Error: {response['error']}"
+            note = f"The request failed: {response['error']}"
+            if response.get("tool_output"):
+                # The history gets the condensed tool results, the user sees the full output
+                note += f"\nCommands that ran before the error:\n{response['tool_summary']}"
+                return f"❌ Error: {response['error']}\nCommands that ran before the error:\n{response['tool_output']}".strip(), note
+            return f"❌ Error: {response['error']}", note
 
         try:
             content = response["content"]
             result_text = ""
             tool_results = []
+            bash_blocks = []
 
             for block in content:
                 if block["type"] == "text":
                     result_text += block["text"] + "\n"
                 elif block["type"] == "tool_use":
                     if block["name"] == "bash":
-                        command = block["input"]["command"]
-                        print(f"🔧 Executing: {command}")
-
-                        # Execute the bash command
-                        import subprocess
-                        try:
-                            result = subprocess.run(
-                                command,
-                                shell=True,
-                                capture_output=True,
-                                text=True,
-                                timeout=30
-                            )
-
-                            tool_result = {
-                                "type": "tool_result",
-                                "tool_use_id": block["id"],
-                                "content": f"Exit code: {result.returncode}\nStdout: {result.stdout}\nStderr: {result.stderr}"
-                            }
-
-                            tool_results.append(tool_result)
-
-                            if result.returncode == 0:
-                                result_text += f"✅ Command successful:\n{result.stdout}\n"
-                            else:
-                                result_text += f"❌ Command failed (exit {result.returncode}):\n{result.stderr}\n"
-
-                        except subprocess.TimeoutExpired:
-                            result_text += "⏰ Command timed out\n"
-                        except Exception as e:
-                            result_text += f"❌ Error executing command: {str(e)}\n"
+                        bash_blocks.append(block)
+
+            # Commands were started while streaming; collect them in Claude's order
+            futures = [
+                self.pending_tool_runs.pop(block["id"], None) or self.executor.submit(self.execute_bash_block, block)
+                for block in bash_blocks
+            ]
+
+            for tool_result, output_text in (future.result() for future in futures):
+                tool_results.append(tool_result)
+                result_text += output_text
+
+            if content:
+                self.conversation_history.append({"role": "assistant", "content": content})
 
             # If there were tool calls, send the results back to Claude and get the follow-up response
             if tool_results:
-                self.conversation_history.append({"role": "assistant", "content": content})
                 self.conversation_history.append({"role": "user", "content": tool_results})
 
                 # Get Claude's follow-up response after tool execution
-                follow_up_response = self.send_message_to_claude("")
-                follow_up_text = self.process_claude_response(follow_up_response)
+                follow_up_response = self.send_message_to_claude()
+                follow_up_text, failure = self.process_claude_response(follow_up_response)
                 result_text += follow_up_text
+                return result_text.strip(), failure
 
-            return result_text.strip()
+            return result_text.strip(), None
 
         except Exception as e:
-            return f"❌ Error processing response: {str(e)}"
+            return f"❌ Error processing response: {str(e)}", f"The request failed: error processing response: {str(e)}"
+
+    def run_pvesh_request(self, tokens: List[str]) -> Optional[subprocess.CompletedProcess]:
+        """Run a pvesh command against the Proxmox REST API, or return None to fall back to pvesh"""
+        request = pvesh_to_rest(tokens)
+        if not request:
+            return None
+        method, path, params = request
+
+        try:
+            with self.pve_session.request(
+                method,
+                self.pve_url + path,
+                # pveproxy only reads a request body for POST and PUT
+                params=params if method in ("GET", "DELETE") else None,
+                data=params if method in ("POST", "PUT") else None,
+                timeout=COMMAND_TIMEOUT,
+                stream=True
+            ) as response:
+                # Same cap as command output, so a huge response is never buffered whole
+                content = bytearray()
+                for chunk in response.iter_content(OUTPUT_READ_SIZE):
+                    content += chunk
+                    if len(content) > COMMAND_OUTPUT_LIMIT:
+                        break
+        except requests.exceptions.RequestException:
+            # pveproxy unreachable, pvesh talks to the cluster directly
+            return None
+
+        if len(content) > COMMAND_OUTPUT_LIMIT:
+            stdout = content[:COMMAND_OUTPUT_LIMIT].decode("utf-8", errors="replace")
+            result = subprocess.CompletedProcess(
+                tokens, 1, f"{stdout}\n[truncated: response exceeded {COMMAND_OUTPUT_LIMIT // 1024} KiB, request was stopped]", ""
+            )
+            result.truncated = True
+            return result
+
+        try:
+            body = json.loads(content)
+        except ValueError:
+            body = {}
+
+        if response.ok:
+            data = body.get("data")
+            if isinstance(data, str) and data.startswith("UPID:"):
+                # pvesh runs worker tasks in the foreground, so wait for the task to finish as well
+                return self.wait_for_task(tokens, data)
+            return subprocess.CompletedProcess(tokens, 0, json.dumps(data, separators=(",", ":")) + "\n", "")
+
+        detail = f"\n{json.dumps(body['errors'])}" if body.get("errors") else ""
+        return subprocess.CompletedProcess(tokens, 1, "", f"{response.status_code} {response.reason}{detail}\n")
+
+    def wait_for_task(self, tokens: List[str], upid: str) -> subprocess.CompletedProcess:
+        """Poll a Proxmox worker task until it stops and map its exit status to a return code"""
+        node = upid.split(":")[1]
+        status_url = f"{self.pve_url}/nodes/{node}/tasks/{quote(upid, safe='')}/status"
+        deadline = time.monotonic() + COMMAND_TIMEOUT
+
+        while True:
+            try:
+                response = self.pve_session.get(status_url, timeout=COMMAND_TIMEOUT)
+                response.raise_for_status()
+                task = response.json().get("data") or {}
+            except (requests.exceptions.RequestException, ValueError) as e:
+                # The task is already queued, so running pvesh again would repeat it
+                return subprocess.CompletedProcess(tokens, 1, f"{upid}\n", f"Could not read task status: {e}\n")
+
+            if task.get("status") == "stopped":
+                break
+            if time.monotonic() >= deadline:
+                raise subprocess.TimeoutExpired(tokens, COMMAND_TIMEOUT)
+            time.sleep(TASK_POLL_INTERVAL)
+
+        exitstatus = task.get("exitstatus", "")
+        if exitstatus == "OK" or exitstatus.startswith("WARNINGS"):
+            return subprocess.CompletedProcess(tokens, 0, f"{upid}\n{exitstatus}\n", "")
+        return subprocess.CompletedProcess(tokens, 1, f"{upid}\n", f"{exitstatus}\n")
+
+    def execute_bash_block(self, block: Dict) -> Tuple[Dict, str]:
+        """Execute a bash tool_use block and return its tool_result and display text"""
+        command = block["input"]["command"]
+        print(f"🔧 Executing: {command}")
+
+        # Execute the bash command, skipping the /bin/sh hop when nothing needs a shell
+        try:
+            tokens = split_plain_command(command)
+            # Keyed on the argv tuple so quoting differences can't collide
+            cache_key = tuple(tokens) if tokens and " ".join(tokens).startswith(READ_ONLY_PREFIXES) else None
+            cached = self.command_cache.get(cache_key) if cache_key else None
+
+            if cached and time.monotonic() - cached[0] < CACHE_TTL:
+                result = cached[1]
+            else:
+                result = self.run_pvesh_request(tokens) if tokens and self.pve_session else None
+                if result is None:
+                    try:
+                        result = run_command(tokens if tokens else command, shell=tokens is None)
+                    except FileNotFoundError:
+                        if tokens is None:
+                            raise
+                        # Shell builtins such as cd have no executable, let the shell handle them
+                        result = run_command(command, shell=True)
+
+                if cache_key and result.returncode == 0:
+                    now = time.monotonic()
+                    for key, (timestamp, _) in list(self.command_cache.items()):
+                        if now - timestamp >= CACHE_TTL:
+                            self.command_cache.pop(key, None)
+                    self.command_cache[cache_key] = (now, result)
+                elif MUTATING_COMMAND.search(command):
+                    # VM state may have changed, so no cached read can be trusted
+                    self.command_cache.clear()
+
+            truncated = getattr(result, "truncated", False)
+            status = "stopped at the output limit" if truncated else result.returncode
+            tool_result = {
+                "type": "tool_result",
+                "tool_use_id": block["id"],
+                "content": f"Exit code: {status}\nStdout: {condense_output(result.stdout)}\nStderr: {condense_output(result.stderr)}"
+            }
+
+            if truncated:
+                return tool_result, f"✂️ Command output truncated:\n{result.stdout}\n{result.stderr}\n"
+            if result.returncode == 0:
+                return tool_result, f"✅ Command successful:\n{result.stdout}\n"
+            return tool_result, f"❌ Command failed (exit {result.returncode}):\n{result.stderr}\n"
+
+        except subprocess.TimeoutExpired:
+            if MUTATING_COMMAND.search(command):
+                # A task still running in the background may change VM state at any time
+                self.command_cache.clear()
+            error = "Command timed out"
+            output_text = "⏰ Command timed out\n"
+        except Exception as e:
+            error = f"Error executing command: {str(e)}"
+            output_text = f"❌ Error executing command: {str(e)}\n"
+
+        # Every tool_use needs a tool_result, failures included
+        return {"type": "tool_result", "tool_use_id": block["id"], "content": error, "is_error": True}, output_text
+
+    def compact_history(self):
+        """Once history exceeds HISTORY_LIMIT entries, summarize all but about the last HISTORY_TARGET"""
+        history = self.conversation_history
+        if len(history) <= HISTORY_LIMIT:
+            return
+
+        # Cut in front of a plain user message or an assistant message so no tool_use loses its
+        # tool_result; the latter lets a long tool loop be compacted too
+        cuts = [
+            i for i in range(1, len(history))
+            if history[i]["role"] == "assistant" or isinstance(history[i]["content"], str)
+        ]
+        cut = next((i for i in cuts if i >= len(history) - HISTORY_TARGET), cuts[-1] if cuts else None)
+        if not cut:
+            return
+
+        payload = {
+            **PAYLOAD_BASE,
+            "max_tokens": 1000,
+            "messages": history[:cut] + [{"role": "user", "content": SUMMARY_PROMPT}],
+            "tool_choice": {"type": "none"}
+        }
+        response = self.post_to_claude(payload)
+        if "error" in response:
+            # Keep the full history and try again on the next turn
+            return
+
+        summary = "\n".join(block["text"] for block in response.get("content", []) if block["type"] == "text")
+        if summary:
+            history[:cut] = [{"role": "user", "content": f"Summary of the earlier conversation:\n{summary}"}]
+
+    def elide_old_tool_results(self):
+        """Keep the newest TOOL_RESULTS_KEPT tool results verbatim and stub out older ones"""
+        seen = 0
+        for entry in reversed(self.conversation_history):
+            if entry["role"] != "user" or isinstance(entry["content"], str):
+                continue
+
+            for block in reversed(entry["content"]):
+                if block.get("type") != "tool_result":
+                    continue
+                seen += 1
+                if seen <= TOOL_RESULTS_KEPT or block["content"].startswith("[Older tool result"):
+                    continue
+
+                content = block["content"]
+                status = "error" if block.get("is_error") else content.split("\n", 1)[0].lower()
+                block["content"] = f"[Older tool result elided: {status}, {len(content)} characters]"
+
+    def run_intent(self, message: str, command: str) -> str:
+        """Run the command for a locally matched intent and record it in the history"""
+        tool_result, output_text = self.execute_bash_block({"id": "local", "input": {"command": command}})
+
+        # Let Claude see what happened when the next message does go through the API
+        self.conversation_history.append({"role": "user", "content": message})
+        self.conversation_history.append({"role": "assistant", "content": f"I ran `{command}`.\n{tool_result['content']}"})
+
+        return output_text.strip()
 
     def chat(self, message: str) -> str:
         """Send a message to Claude and return the response"""
+        command = match_intent(message)
+        if command:
+            return self.run_intent(message, command)
+
+        self.compact_history()
+        history_length = len(self.conversation_history)
         self.conversation_history.append({"role": "user", "content": message})
 
-        response = self.send_message_to_claude(message)
-        result = self.process_claude_response(response)
+        response = self.send_message_to_claude()
+        result, failure = self.process_claude_response(response)
+
+        if failure:
+            if len(self.conversation_history) == history_length + 1 and not response.get("tool_output"):
+                # Nothing ran, so drop the message and start the next request from a clean history
+                del self.conversation_history[history_length:]
+            else:
+                # Commands did run, so keep the turn and close it with what happened
+                self.conversation_history.append({"role": "assistant", "content": failure})
+
+        self.elide_old_tool_results()
 
         return result
 
@@ -164,6 +670,12 @@ Always use the bash tool to execute these commands and provide helpful, concise
         print("Type 'exit' to quit, 'clear' to clear history")
         print("=" * 50)
 
+        # readline gives input() line editing and up-arrow recall of earlier prompts
+        try:
+            import readline
+        except ImportError:
+            pass
+
         while True:
             try:
                 user_input = input("\n🔥 You: ").strip()
@@ -188,16 +700,20 @@ Always use the bash tool to execute these commands and provide helpful, concise
             except Exception as e:
                 print(f"❌ Error: {str(e)}")
 
+@functools.lru_cache(maxsize=1)
+def config_path() -> Path:
+    """Return the resolved path of the configuration file"""
+    return Path("~/.config/claude-proxmox/config.json").expanduser()
+
+@functools.lru_cache(maxsize=1)
 def load_config():
     """Load configuration from file or environment"""
-    config_file = os.path.expanduser("~/.config/claude-proxmox/config.json")
-
-    if os.path.exists(config_file):
-        try:
-            with open(config_file, 'r') as f:
-                return json.load(f)
-        except Exception as e:
-            print(f"❌ Error loading config: {e}")
+    try:
+        return json.loads(config_path().read_bytes())
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"❌ Error loading config: {e}")
 
     # Fallback to environment variable
     api_key = os.getenv('ANTHROPIC_API_KEY')
@@ -208,18 +724,17 @@ def load_config():
 
 def create_config():
     """Create configuration file"""
-    config_dir = os.path.expanduser("~/.config/claude-proxmox")
-    config_file = os.path.join(config_dir, "config.json")
+    config_file = config_path()
 
     api_key = input("Enter your Anthropic API key: ").strip()
 
-    os.makedirs(config_dir, exist_ok=True)
+    config_file.parent.mkdir(parents=True, exist_ok=True)
 
     config = {'api_key': api_key}
 
     try:
-        with open(config_file, 'w') as f:
-            json.dump(config, f, indent=2)
+        config_file.write_text(json.dumps(config, indent=2))
+        load_config.cache_clear()
         print(f"✅ Configuration saved to {config_file}")
         return config
     except Exception as e:
@@ -237,7 +752,12 @@ def main():
         print("❌ No API key found. Run 'python3 proxmox_vm_agent.py setup' to configure.")
         return
 
-    agent = ProxmoxClaudeAgent(config['api_key'])
+    agent = ProxmoxClaudeAgent(
+        config['api_key'],
+        pve_api_token=config.get('pve_api_token'),
+        pve_host=config.get('pve_host', '127.0.0.1'),
+        pve_verify_ssl=config.get('pve_verify_ssl', False)
+    )
 
     if len(sys.argv) > 1:
         # Command mode